@@ -1,11 +1,15 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
 import fitz  # PyMuPDF
 import cv2
 import numpy as np
 import os
 import base64
+import json
+import uuid
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from PIL import Image
 from chessboard_detection.chessboard_detector import ChessboardDetector
 
 app = Flask(__name__)
@@ -20,6 +24,108 @@ for folder in [app.config['UPLOAD_FOLDER'], app.config['STATIC_FOLDER']]:
 
 chess_detector = ChessboardDetector()
 
+PREVIEW_JPEG_QUALITY = 80
+# Previews are rendered at half resolution in grayscale; segmentation at upload
+# and /analyze both use the page at full resolution in colour
+PREVIEW_SCALE = 0.5
+
+# Directly uploaded images are decoded at 1/2, 1/4 or 1/8 scale while their
+# longest side stays at least this long; YOLO resizes to 640px anyway
+MAX_ANALYSIS_SIDE = 1280
+REDUCED_COLOR_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+# Uploaded PDFs and the chessboard boxes detected on each page, keyed by upload id
+MAX_CACHED_UPLOADS = 16
+SEG_BATCH_SIZE = 8
+ENCODE_WORKERS = os.cpu_count() or 1
+upload_cache = OrderedDict()
+upload_cache_lock = threading.Lock()
+# PyMuPDF must not be called from several threads at once, even on separate
+# documents, and /upload and /analyze run on separate request threads
+fitz_lock = threading.Lock()
+
+def register_upload(pdf_data, page_count):
+    """Create a cache entry for a new upload and return its id."""
+    upload_id = uuid.uuid4().hex
+    with upload_cache_lock:
+        upload_cache[upload_id] = {"pdf_data": pdf_data, "page_count": page_count, "chessboards": {}}
+        while len(upload_cache) > MAX_CACHED_UPLOADS:
+            upload_cache.popitem(last=False)
+    return upload_id
+
+def cache_chessboards(upload_id, pages, page_boxes):
+    """Store the chessboard boxes detected for the given pages of an upload."""
+    with upload_cache_lock:
+        cached = upload_cache.get(upload_id)
+        if cached is not None:
+            cached["chessboards"].update(zip(pages, page_boxes))
+
+def cached_upload(upload_id):
+    """Return the cache entry for an upload, or None if it has been evicted."""
+    with upload_cache_lock:
+        cached = upload_cache.get(upload_id)
+        if cached is not None:
+            upload_cache.move_to_end(upload_id)
+        return cached
+
+def reduction_factor(longest_side):
+    """Largest of 1, 2, 4 or 8 that keeps the longest side at MAX_ANALYSIS_SIDE or more."""
+    factor = 1
+    while factor < 8 and longest_side // (factor * 2) >= MAX_ANALYSIS_SIDE:
+        factor *= 2
+    return factor
+
+def decode_image(image_bytes):
+    """Decode an uploaded image, shrinking it when it is much larger than needed.
+
+    Returns the BGR image and the factor its coordinates were divided by.
+    JPEGs are decoded directly at reduced scale, which libjpeg does far more
+    cheaply than a full decode; other formats are resized after decoding.
+    """
+    np_arr = np.frombuffer(image_bytes, np.uint8)
+    if image_bytes[:2] == b'\xff\xd8':
+        # A 1/8 scale grayscale decode is enough to learn the image size
+        probe = cv2.imdecode(np_arr, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if probe is None:
+            return None, 1
+        factor = reduction_factor(max(probe.shape[:2]) * 8)
+        return cv2.imdecode(np_arr, REDUCED_COLOR_FLAGS[factor]), factor
+
+    image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+    if image is None:
+        return None, 1
+    factor = reduction_factor(max(image.shape[:2]))
+    if factor > 1:
+        image = cv2.resize(image, None, fx=1 / factor, fy=1 / factor, interpolation=cv2.INTER_AREA)
+    return image, factor
+
+def encode_preview(gray):
+    """Encode a grayscale preview as a JPEG data URL."""
+    _, buffer = cv2.imencode('.jpg', gray, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY])
+    base64_img = base64.b64encode(buffer).decode("utf-8")
+    return f"data:image/jpeg;base64,{base64_img}"
+
+def pixmap_view(pix):
+    """Return a numpy view over a pixmap's samples without copying them.
+
+    The view is only valid while ``pix`` is alive.
+    """
+    return np.frombuffer(pix.samples_mv, np.uint8).reshape(pix.height, pix.width, pix.n)
+
+def render_page(pdf_data, page_num):
+    """Render a single PDF page at full resolution as a BGR image."""
+    with fitz_lock, fitz.open(stream=pdf_data, filetype="pdf") as doc:
+        pix = doc.load_page(page_num).get_pixmap(alpha=False)
+        # The colour conversion is the only copy and detaches the image from the pixmap
+        bgr = cv2.cvtColor(pixmap_view(pix), cv2.COLOR_RGB2BGR)
+        pix = None
+        return bgr
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -36,68 +142,158 @@ def handle_upload():
     # Read PDF content into memory
     pdf_data = file.read()
 
-    previews = []
     try:
-        doc = fitz.open(stream=pdf_data, filetype="pdf")
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            pix = page.get_pixmap()
-            
-            # Convert to PIL Image
-            img_pil = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            
-            # Convert to base64
-            buffer = BytesIO()
-            img_pil.save(buffer, format="JPEG")
-            base64_img = base64.b64encode(buffer.getvalue()).decode("utf-8")
-            
-            previews.append({
-                "preview_data": f"data:image/jpeg;base64,{base64_img}",
-                "page": page_num,
-                "original_width": pix.width,
-                "original_height": pix.height
-            })
-        return jsonify({"previews": previews})
+        with fitz_lock:
+            doc = fitz.open(stream=pdf_data, filetype="pdf")
+            page_count = len(doc)
     except Exception as e:
         return jsonify({"error": f"PDF processing failed: {str(e)}"}), 500
 
+    upload_id = register_upload(pdf_data, page_count)
+    preview_matrix = fitz.Matrix(PREVIEW_SCALE, PREVIEW_SCALE)
+
+    def generate():
+        yield json.dumps({"upload_id": upload_id, "page_count": page_count}) + "\n"
+
+        pending_pages = []
+        pending_images = []
+
+        def flush_pending():
+            # Run segmentation on a batch of full-resolution colour pages so
+            # /analyze can skip it; the boxes are in the coordinates of the
+            # page it re-renders
+            boxes = chess_detector.detect_chessboards_batch(pending_images)
+            cache_chessboards(upload_id, pending_pages, boxes)
+            pending_pages.clear()
+            pending_images.clear()
+
+        # Pages are rendered here, one at a time, because PyMuPDF is not
+        # thread-safe. JPEG encoding and the colour conversion for
+        # segmentation run on worker threads, since OpenCV releases the GIL,
+        # so they overlap with rendering the next pages. Each pixmap stays
+        # referenced until its work finishes and is released on this thread.
+        in_flight = deque()
+
+        def finish_oldest_page():
+            preview, pixmaps, encoded, converted = in_flight.popleft()
+            preview["preview_data"] = encoded.result()
+            seg_image = converted.result()
+            with fitz_lock:
+                pixmaps = None
+                fitz.TOOLS.store_shrink(100)
+
+            yield json.dumps(preview) + "\n"
+
+            pending_pages.append(preview["page"])
+            pending_images.append(seg_image)
+            if len(pending_images) >= SEG_BATCH_SIZE:
+                flush_pending()
+
+        try:
+            with ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as executor:
+                for page_num in range(page_count):
+                    # The lock is never held across a yield, so a slow client
+                    # cannot stall /analyze
+                    with fitz_lock:
+                        page = doc.load_page(page_num)
+                        pix = page.get_pixmap(matrix=preview_matrix, colorspace=fitz.csGRAY, alpha=False)
+                        # Segmentation sees the same full-resolution colour page
+                        # that /analyze renders
+                        seg_pix = page.get_pixmap(alpha=False)
+                        preview = {
+                            "page": page_num,
+                            "original_width": int(page.rect.width),
+                            "original_height": int(page.rect.height)
+                        }
+                        views = pixmap_view(pix), pixmap_view(seg_pix)
+                        page = None
+                    in_flight.append((
+                        preview,
+                        (pix, seg_pix),
+                        executor.submit(encode_preview, views[0]),
+                        executor.submit(cv2.cvtColor, views[1], cv2.COLOR_RGB2BGR)
+                    ))
+                    pix = seg_pix = views = None
+
+                    if len(in_flight) > ENCODE_WORKERS:
+                        yield from finish_oldest_page()
+
+                while in_flight:
+                    yield from finish_oldest_page()
+
+            if pending_images:
+                flush_pending()
+        except Exception as e:
+            yield json.dumps({"error": f"PDF processing failed: {str(e)}"}) + "\n"
+        finally:
+            with fitz_lock:
+                in_flight.clear()
+                doc.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/analyze', methods=['POST'])
 def handle_analysis():
-    data = request.json
-    if 'image' not in data or 'origX' not in data or 'origY' not in data:
-        return jsonify({"error": "Missing parameters: image, origX, and origY are required"}), 400
+    data = request.form
+    if 'origX' not in data or 'origY' not in data:
+        return jsonify({"error": "Missing parameters: origX and origY are required"}), 400
+    from_upload = 'upload_id' in data and 'page' in data
+    if not from_upload and 'image' not in request.files:
+        return jsonify({"error": "Missing parameters: either upload_id and page, or an image file, are required"}), 400
 
     try:
-        # Ensure 'image' is a string
-        if not isinstance(data['image'], str):
-            return jsonify({"error": "Invalid image data format: expected base64 string"}), 400
-
-        # Extract base64 image data
-        header, encoded = data['image'].split(",", 1)
-        image_data = base64.b64decode(encoded)
-        np_arr = np.frombuffer(image_data, np.uint8)
-        image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+        chessboards = None
+        scale = 1
+        if from_upload:
+            # Re-render the selected page at full resolution and reuse the
+            # boxes found at upload time when they are ready
+            cached = cached_upload(data['upload_id'])
+            if cached is None:
+                return jsonify({"error": "Upload not found, please upload the PDF again"}), 404
+            try:
+                page_num = int(data['page'])
+            except (TypeError, ValueError):
+                page_num = -1
+            if not 0 <= page_num < cached["page_count"]:
+                return jsonify({"error": f"Invalid page: the PDF has {cached['page_count']} pages"}), 400
+            image = render_page(cached["pdf_data"], page_num)
+            chessboards = cached["chessboards"].get(page_num)
+        else:
+            # Decode the uploaded image bytes directly, reduced if oversized
+            image, scale = decode_image(request.files['image'].read())
+            if image is None:
+                return jsonify({"error": "Invalid image data: could not decode image file"}), 400
 
-        # Get click coordinates
-        x = int(data['origX'])
-        y = int(data['origY'])
+        # Get click coordinates, in the decoded image's pixels. Form fields
+        # are strings, so accept fractional values as JSON numbers were
+        try:
+            x = int(float(data['origX'])) // scale
+            y = int(float(data['origY'])) // scale
+        except (KeyError, ValueError, OverflowError):
+            return jsonify({"error": "Invalid origX/origY"}), 400
 
         # Detect chessboard at clicked location
-        chessboard_crop = chess_detector.find_chessboard(image, (x, y))
-        if chessboard_crop is None:
+        box = chess_detector.find_chessboard_box(image, (x, y), chessboards)
+        if box is None:
             return jsonify({"error": "No chessboard detected at the specified location"}), 404
+        x1, y1, x2, y2 = box
+        chessboard_crop = image[y1:y2, x1:x2]
 
         # Detect pieces and generate FEN
         pieces = chess_detector.detect_chess_pieces(chessboard_crop)
         fen = chess_detector.calculate_fen(chessboard_crop, pieces)
 
-        # Convert chessboard crop to base64 for preview
-        _, buffer = cv2.imencode('.jpg', chessboard_crop)
-        chessboard_b64 = base64.b64encode(buffer).decode('utf-8')
+        # Clients that want the crop's pixels get raw JPEG bytes, with the FEN in a header
+        if request.args.get('include_image') == '1':
+            _, buffer = cv2.imencode('.jpg', chessboard_crop)
+            response = send_file(BytesIO(buffer.tobytes()), mimetype='image/jpeg')
+            response.headers['X-FEN'] = fen
+            return response
 
+        # Otherwise return where the board is, in the coordinates the click was given in
         return jsonify({
             "fen": fen,
-            "chessboard_url": f"data:image/jpeg;base64,{chessboard_b64}"
+            "crop_bbox": [v * scale for v in box]
         })
 
     except Exception as e:
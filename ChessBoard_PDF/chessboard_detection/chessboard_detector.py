@@ -1,21 +1,88 @@
 import os
+import threading
+import torch
 from ultralytics import YOLO
 import cv2
+import numpy as np
+
+SEG_MODEL_PATH = 'SegModel.pt'
+PIECE_MODEL_PATH = 'chessDetection3d.pt'
+EXPORT_IMGSZ = 640
+EXPORT_MAX_BATCH = 16
+
+def export_models():
+    """Export both checkpoints once at deploy time.
+
+    GPU hosts get FP16 TensorRT engines, CPU-only hosts get ONNX models.
+    The exports are written next to the checkpoints and picked up by
+    ChessboardDetector automatically. Each checkpoint's task is recorded
+    beside them, since Ultralytics cannot infer it from an export's path.
+    """
+    use_tensorrt = torch.cuda.is_available()
+    for path in (SEG_MODEL_PATH, PIECE_MODEL_PATH):
+        model = YOLO(path)
+        model.export(
+            format='engine' if use_tensorrt else 'onnx',
+            half=use_tensorrt,
+            imgsz=EXPORT_IMGSZ,
+            dynamic=True,
+            batch=EXPORT_MAX_BATCH
+        )
+        with open(os.path.splitext(path)[0] + '.task', 'w') as f:
+            f.write(model.task)
+
+def model_task(path):
+    """The task of a checkpoint, as recorded by export_models."""
+    try:
+        with open(os.path.splitext(path)[0] + '.task') as f:
+            return f.read().strip()
+    except OSError:
+        # Exported before tasks were recorded: ask the checkpoint itself
+        return YOLO(path).task
+
+def load_model(path):
+    """Load the fastest available export of a checkpoint, else the checkpoint.
+
+    The ONNX export runs on CPU, so GPU hosts without a TensorRT engine use
+    the checkpoint on the GPU instead. Exports are loaded with the
+    checkpoint's task, so a segmentation export is not decoded as detection.
+    """
+    stem = os.path.splitext(path)[0]
+    use_gpu = torch.cuda.is_available()
+    if use_gpu and os.path.exists(stem + '.engine'):
+        return YOLO(stem + '.engine', task=model_task(path))
+    if not use_gpu and os.path.exists(stem + '.onnx'):
+        return YOLO(stem + '.onnx', task=model_task(path))
+    return YOLO(path)
 
 class ChessboardDetector:
     def __init__(self):
         # Load the trained models
-        self.seg_model = YOLO('SegModel.pt')
-        self.piece_model = YOLO('chessDetection3d.pt')
+        self.seg_model = load_model(SEG_MODEL_PATH)
+        self.piece_model = load_model(PIECE_MODEL_PATH)
+        # Ultralytics predictors are not thread-safe, and Flask serves /upload
+        # and /analyze on separate threads, so model calls go one at a time
+        self.model_lock = threading.Lock()
         self.class_map = {
             0: 'p', 1: 'r', 2: 'n', 3: 'b', 4: 'q', 5: 'k',
             6: 'P', 7: 'R', 8: 'N', 9: 'B', 10: 'Q', 11: 'K'
         }
+        self.piece_symbols = np.array([self.class_map[i] for i in range(len(self.class_map))])
+        self.warm_up()
         print("Models loaded successfully!")
 
+    def warm_up(self, runs=3):
+        """Run a few dummy inferences so the first real request is not slow."""
+        dummy = np.zeros((640, 640, 3), dtype=np.uint8)
+        for _ in range(runs):
+            with self.model_lock:
+                self.seg_model(dummy, verbose=False)
+                self.piece_model(dummy, verbose=False)
+
     def detect_chessboards(self, image):
         """Detect all chessboards in the image."""
-        results = self.seg_model(image)
+        with self.model_lock:
+            results = self.seg_model(image)
         chessboards = []
         for r in results:
             for box in r.boxes:
@@ -23,42 +90,53 @@ class ChessboardDetector:
                 chessboards.append((x1, y1, x2, y2))
         return chessboards
 
+    def detect_chessboards_batch(self, images, batch_size=EXPORT_MAX_BATCH):
+        """Detect chessboards in several images, batching the model calls."""
+        chessboards = []
+        for start in range(0, len(images), batch_size):
+            with self.model_lock:
+                results = self.seg_model(images[start:start + batch_size], verbose=False)
+            for r in results:
+                chessboards.append([tuple(map(int, box.xyxy[0])) for box in r.boxes])
+        return chessboards
+
     def detect_chess_pieces(self, image):
-        """Detect chess pieces in the image."""
-        results = self.piece_model(image)
-        pieces = []
-        for r in results:
-            for box in r.boxes:
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
-                cls = int(box.cls[0])
-                conf = float(box.conf[0])
-                pieces.append((x1, y1, x2, y2, cls, conf))
-        return pieces
+        """Detect chess pieces in the image.
+
+        Returns a ``(boxes, classes)`` pair of arrays: ``boxes`` holds one
+        ``(x1, y1, x2, y2)`` row per piece and ``classes`` its class id.
+        """
+        with self.model_lock:
+            results = self.piece_model(image, verbose=False)
+        boxes = [r.boxes.xyxy.cpu().numpy() for r in results]
+        classes = [r.boxes.cls.cpu().numpy() for r in results]
+        if not boxes:
+            return np.empty((0, 4), dtype=int), np.empty(0, dtype=int)
+        return np.concatenate(boxes).astype(int), np.concatenate(classes).astype(int)
 
     def calculate_fen(self, chessboard_img, pieces):
         """Convert detected pieces to FEN notation with correct positioning."""
         height, width = chessboard_img.shape[:2]
         square_w = width / 8
         square_h = height / 8
+        boxes, classes = pieces
 
         # Initialize empty board
-        board = [['' for _ in range(8)] for _ in range(8)]
-
-        for (x1, y1, x2, y2, cls, _) in pieces:
-            # Get piece center coordinates
-            center_x = (x1 + x2) / 2
-            center_y = (y1 + y2) / 2
+        board = np.full((8, 8), '', dtype='<U1')
 
-            # Calculate board position
-            file = int(center_x // square_w)  # File (column) from left to right (a to h)
-            rank = int(center_y // square_h)  # Rank from top to bottom (0 to 7, where 0 is rank 8)
+        # Drop classes the model should never produce
+        known = (classes >= 0) & (classes < len(self.piece_symbols))
+        boxes, classes = boxes[known], classes[known]
 
-            # Ensure correct mapping to FEN
-            board[rank][file] = self.class_map.get(cls, '')
+        # Board position of every piece centre: files run left to right (a to h),
+        # ranks top to bottom (0 to 7, where 0 is rank 8)
+        files = (boxes[:, [0, 2]].mean(axis=1) // square_w).astype(int).clip(0, 7)
+        ranks = (boxes[:, [1, 3]].mean(axis=1) // square_h).astype(int).clip(0, 7)
+        board[ranks, files] = self.piece_symbols[classes]
 
         # Convert to FEN notation
         fen_rows = []
-        for row in board:
+        for row in board.tolist():
             fen = ''
             empty = 0
             for cell in row:
@@ -75,12 +153,27 @@ class ChessboardDetector:
 
         return '/'.join(fen_rows) + ' w - - 0 1'
 
-    def find_chessboard(self, image, click_coords):
-        """Find the chessboard at the given click coordinates in the image."""
+    def find_chessboard_box(self, image, click_coords, chessboards=None):
+        """Return the (x1, y1, x2, y2) box of the chessboard at the click, or None.
+
+        Boxes already detected for this image (e.g. at upload time) can be
+        passed in as ``chessboards`` to skip running segmentation again.
+        """
         x, y = click_coords
-        chessboards = self.detect_chessboards(image)
+        if chessboards is None:
+            chessboards = self.detect_chessboards(image)
         for (x1, y1, x2, y2) in chessboards:
             if x1 <= x <= x2 and y1 <= y <= y2:
-                chessboard_crop = image[y1:y2, x1:x2]
-                return chessboard_crop
-        return None
\ No newline at end of file
+                return (x1, y1, x2, y2)
+        return None
+
+    def find_chessboard(self, image, click_coords, chessboards=None):
+        """Find the chessboard at the given click coordinates in the image."""
+        box = self.find_chessboard_box(image, click_coords, chessboards)
+        if box is None:
+            return None
+        x1, y1, x2, y2 = box
+        return image[y1:y2, x1:x2]
+
+if __name__ == '__main__':
+    export_models()
@@ -0,0 +1,60 @@
+"""Convert the CSV opening book into a Polyglot book for faster lookups.
+
+Usage: python build_book.py [openings_master.csv] [openings_master.bin]
+"""
+import csv
+import struct
+import sys
+from collections import Counter
+
+import chess
+import chess.polyglot
+
+PROMOTION_CODES = {chess.KNIGHT: 1, chess.BISHOP: 2, chess.ROOK: 3, chess.QUEEN: 4}
+
+def encode_move(board: chess.Board, move: chess.Move) -> int:
+    to_square = move.to_square
+    # Polyglot encodes castling as the king moving onto its own rook
+    if board.is_castling(move):
+        rook_file = 7 if chess.square_file(move.to_square) > chess.square_file(move.from_square) else 0
+        to_square = chess.square(rook_file, chess.square_rank(move.from_square))
+    return (
+        chess.square_file(to_square)
+        | chess.square_rank(to_square) << 3
+        | chess.square_file(move.from_square) << 6
+        | chess.square_rank(move.from_square) << 9
+        | PROMOTION_CODES.get(move.promotion, 0) << 12
+    )
+
+def build_polyglot_book(csv_path: str, bin_path: str) -> int:
+    """Write every book move as a Polyglot entry weighted by how many lines play it."""
+    weights = Counter()
+    with open(csv_path, newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)  # skip header
+        for row in reader:
+            if len(row) < 3:
+                continue
+            board = chess.Board()
+            for token in row[2].split():
+                if "." in token:
+                    continue
+                try:
+                    move = board.parse_san(token)
+                except ValueError:
+                    break
+                weights[chess.polyglot.zobrist_hash(board), encode_move(board, move)] += 1
+                board.push(move)
+
+    # Entries must be sorted by key; within a key, heavier moves come first
+    entries = sorted(weights.items(), key=lambda item: (item[0][0], -item[1]))
+    with open(bin_path, "wb") as f:
+        for (key, raw_move), weight in entries:
+            f.write(struct.pack(">QHHI", key, raw_move, min(weight, 0xFFFF), 0))
+    return len(entries)
+
+if __name__ == "__main__":
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else "openings_master.csv"
+    bin_path = sys.argv[2] if len(sys.argv) > 2 else "openings_master.bin"
+    count = build_polyglot_book(csv_path, bin_path)
+    print(f"Wrote {count} entries to {bin_path}")
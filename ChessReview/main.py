@@ -1,13 +1,22 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
+import io
 import os
 import tempfile
 import chess.pgn
 import chess.engine
+import chess.polyglot
+import numpy as np
 from enum import Enum
-from typing import List, Dict
+from typing import List, Dict, TextIO, Union
 from datetime import datetime
 import csv
 import json
+import pickle
+import queue
+import hashlib
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 app = FastAPI()
 
@@ -53,37 +62,64 @@ centipawn_classifications = [
     Classification.BLUNDER,
 ]
 
+# Eval-loss threshold for each classification in centipawn_classifications
+# (BLUNDER has none) as quadratic coefficients (a, b, c) of the previous
+# evaluation p: max(a * p**2 + b * p + c, 0)
+THRESHOLD_COEFFS = np.array([
+    [0.0001, 0.0236, -3.7143],
+    [0.0002, 0.1231, 27.5455],
+    [0.0002, 0.2643, 60.5455],
+    [0.0002, 0.3624, 108.0909],
+    [0.00025, 0.38255, 166.9541],
+    [0.0003, 0.4027, 225.8182],
+])
+
 # Analysis parameters
 FORCED_WIN_THRESHOLD = 500
 MISS_CENTIPAWN_LOSS = 300
 MISS_MATE_THRESHOLD = 3
 ENDGAME_MATERIAL_THRESHOLD = 24
 QUEEN_VALUE = 9
+# Material value indexed by piece type (chess.PAWN .. chess.KING)
+PIECE_VALUES = (0, 1, 3, 3, 5, QUEEN_VALUE, 0)
+MATERIAL_PIECE_TYPES = (chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN)
+ANALYSIS_DEPTH = 20
+# Moves are searched at SHALLOW_ANALYSIS_DEPTH first and again at ANALYSIS_DEPTH
+# only when the eval loss is within DEEPER_SEARCH_MARGIN of a threshold
+SHALLOW_ANALYSIS_DEPTH = 12
+DEEPER_SEARCH_MARGIN = 0.2
+DEFAULT_BOOK_CSV = "openings_master.csv"
+# Polyglot build of the CSV book (see build_book.py), used instead when present
+DEFAULT_BOOK_BIN = "openings_master.bin"
+DEFAULT_BOOK = DEFAULT_BOOK_BIN if os.path.exists(DEFAULT_BOOK_BIN) else DEFAULT_BOOK_CSV
+# Bump when the parsed opening book format changes to invalidate pickled copies
+BOOK_CACHE_VERSION = 2
+
+# Engine analyses shared across moves and requests, keyed by engine, its mtime,
+# depth and FEN so that a replaced engine binary misses the cache
+ANALYSIS_CACHE_SIZE = 10000
+analysis_cache = {}
+
+# Finished game analyses, keyed by result_digest(): a small in-memory tier in
+# front of one JSON file per game on disk
+RESULT_CACHE_DIR = "result_cache"
+RESULT_CACHE_SIZE = 128
+result_cache = OrderedDict()
+# Bump when the analysis logic or the result format changes to invalidate cached results
+RESULT_CACHE_VERSION = 1
+
+# Number of Stockfish processes used to analyse a game's positions in parallel
+ENGINE_POOL_SIZE = min(os.cpu_count() or 1, 4)
 
 def detect_game_phase(board: chess.Board, in_opening: bool) -> GamePhase:
     if in_opening:
         return GamePhase.OPENING
-        
+
     total_material = 0
-    queens = 0
-    
-    for color in [chess.WHITE, chess.BLACK]:
-        for piece_type in chess.PIECE_TYPES:
-            if piece_type == chess.KING:
-                continue
-                
-            count = len(board.pieces(piece_type, color))
-            value = {
-                chess.PAWN: 1,
-                chess.KNIGHT: 3,
-                chess.BISHOP: 3,
-                chess.ROOK: 5,
-                chess.QUEEN: QUEEN_VALUE
-            }[piece_type]
-            
-            total_material += count * value
-            if piece_type == chess.QUEEN:
-                queens += count
+    for color in (chess.WHITE, chess.BLACK):
+        for piece_type in MATERIAL_PIECE_TYPES:
+            total_material += PIECE_VALUES[piece_type] * chess.popcount(board.pieces_mask(piece_type, color))
+    queens = chess.popcount(board.queens)
 
     endgame_conditions = [
         total_material <= ENDGAME_MATERIAL_THRESHOLD,
@@ -92,22 +128,27 @@ def detect_game_phase(board: chess.Board, in_opening: bool) -> GamePhase:
     
     return GamePhase.ENDGAME if any(endgame_conditions) else GamePhase.MIDDLEGAME
 
-def get_evaluation_loss_threshold(classif: Classification, prev_eval: float) -> float:
+def white_eval(info: Dict) -> int:
+    return info["score"].white().score(mate_score=10000) or 0
+
+def evaluation_loss_thresholds(prev_eval: float) -> np.ndarray:
+    """Upper eval-loss bound of each classification in centipawn_classifications but BLUNDER."""
     prev_eval = abs(prev_eval)
-    if classif == Classification.BEST:
-        return max(0.0001 * prev_eval**2 + 0.0236 * prev_eval - 3.7143, 0)
-    elif classif == Classification.EXCELLENT:
-        return max(0.0002 * prev_eval**2 + 0.1231 * prev_eval + 27.5455, 0)
-    elif classif == Classification.GOOD:
-        return max(0.0002 * prev_eval**2 + 0.2643 * prev_eval + 60.5455, 0)
-    elif classif == Classification.INACCURACY:
-        return max(0.0002 * prev_eval**2 + 0.3624 * prev_eval + 108.0909, 0)
-    elif classif == Classification.MISS:
-        return max(0.00025 * prev_eval**2 + 0.38255 * prev_eval + 166.9541, 0)
-    elif classif == Classification.MISTAKE:
-        return max(0.0003 * prev_eval**2 + 0.4027 * prev_eval + 225.8182, 0)
-    else:
-        return float("inf")
+    return np.maximum(THRESHOLD_COEFFS @ (prev_eval * prev_eval, prev_eval, 1.0), 0)
+
+def classify_eval_loss(prev_eval: float, eval_loss: float) -> Classification:
+    # Thresholds grow with each classification, so the first one not below
+    # the loss is where it belongs; past the last one it is a blunder
+    index = np.searchsorted(evaluation_loss_thresholds(prev_eval), eval_loss)
+    return centipawn_classifications[index]
+
+def near_classification_boundary(prev_eval: float, eval_loss: float) -> bool:
+    """Whether a shallow search's eval loss is too close to a threshold to trust."""
+    thresholds = evaluation_loss_thresholds(prev_eval)
+    return bool(np.any(np.abs(eval_loss - thresholds) <= DEEPER_SEARCH_MARGIN * thresholds))
+
+# Either a parsed CSV book (Zobrist key of the position -> book move) or a Polyglot reader
+OpeningBook = Union[Dict[int, str], chess.polyglot.MemoryMappedReader]
 
 def load_opening_book(csv_path):
     opening_book = {}
@@ -126,25 +167,131 @@ def load_opening_book(csv_path):
                         continue
                     try:
                         chess_move = board.push_san(move)
-                        fen = " ".join(board.fen().split()[:4])
-                        opening_book[fen] = chess_move.uci()
+                        opening_book[chess.polyglot.zobrist_hash(board)] = chess_move.uci()
                     except ValueError:
                         break
     except Exception as e:
         print(f"Error loading opening book: {e}")
     return opening_book
 
+def get_opening_book(csv_path: str) -> OpeningBook:
+    """Load the opening book, reusing a pickled copy while the CSV is unchanged.
+
+    A Polyglot ``.bin`` book is memory-mapped and looked up directly instead.
+    """
+    if csv_path.endswith(".bin"):
+        try:
+            return chess.polyglot.open_reader(csv_path)
+        except OSError as e:
+            print(f"Error loading opening book: {e}")
+            return {}
+
+    cache_path = csv_path + ".pkl"
+    try:
+        mtime = os.path.getmtime(csv_path)
+    except OSError as e:
+        print(f"Error loading opening book: {e}")
+        return {}
+
+    try:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+        if cached["version"] == BOOK_CACHE_VERSION and cached["mtime"] == mtime:
+            return cached["book"]
+    except Exception:
+        pass
+
+    opening_book = load_opening_book(csv_path)
+    if opening_book:
+        try:
+            with open(cache_path, "wb") as f:
+                pickle.dump({"version": BOOK_CACHE_VERSION, "mtime": mtime, "book": opening_book}, f)
+        except OSError as e:
+            print(f"Error caching opening book: {e}")
+    return opening_book
+
 def is_book_move(board, opening_book, max_depth=8):  
     if board.fullmove_number > max_depth:  
         return None  
-    fen = " ".join(board.fen().split()[:4])
-    return opening_book.get(fen)
+    if isinstance(opening_book, chess.polyglot.MemoryMappedReader):
+        # Polyglot entries are keyed on the position before the move, so look
+        # up the move that led to this position from its parent
+        if not board.move_stack:
+            return None
+        move = board.pop()
+        try:
+            in_book = any(entry.move == move for entry in opening_book.find_all(board))
+        finally:
+            board.push(move)
+        return move.uci() if in_book else None
+    return opening_book.get(chess.polyglot.zobrist_hash(board))
 
-def analyze_pgn_with_stockfish(pgn_file: str, engine_path: str, book_csv: str) -> Dict:
-    opening_book = load_opening_book(book_csv)
-    
-    with open(pgn_file) as pgn:
-        game = chess.pgn.read_game(pgn)
+class EnginePool:
+    """A set of Stockfish processes that analyse independent positions in parallel.
+
+    Engines are started on first use, so games whose positions are all
+    cached never spawn a process.
+    """
+
+    def __init__(self, engine_path: str, size: int = ENGINE_POOL_SIZE):
+        self.engine_path = engine_path
+        self.size = size
+        self._engines = []
+        self._idle = queue.Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for engine in self._engines:
+            engine.quit()
+        self._engines = []
+        self._idle = queue.Queue()
+
+    def _start(self, count: int):
+        while len(self._engines) < count:
+            engine = chess.engine.SimpleEngine.popen_uci(self.engine_path)
+            self._engines.append(engine)
+            self._idle.put(engine)
+
+    def _analyse(self, board: chess.Board, depth: int) -> Dict:
+        engine = self._idle.get()
+        try:
+            return engine.analyse(board, chess.engine.Limit(depth=depth))
+        finally:
+            self._idle.put(engine)
+
+    def analyse_many(self, boards: List[chess.Board], depth: int = ANALYSIS_DEPTH) -> List[Dict]:
+        """Analyse every board, searching each distinct uncached position once."""
+        infos = {}
+        pending = {}
+        engine_mtime = file_mtime(self.engine_path)
+        for board in boards:
+            fen = board.fen()
+            info = analysis_cache.get((self.engine_path, engine_mtime, depth, fen))
+            if info is not None:
+                infos[fen] = info
+            elif fen not in pending:
+                pending[fen] = board
+
+        if pending:
+            workers = min(self.size, len(pending))
+            self._start(workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                analysed = executor.map(lambda board: self._analyse(board, depth), pending.values())
+                for fen, info in zip(pending, analysed):
+                    if len(analysis_cache) >= ANALYSIS_CACHE_SIZE:
+                        analysis_cache.pop(next(iter(analysis_cache)))
+                    analysis_cache[(self.engine_path, engine_mtime, depth, fen)] = info
+                    infos[fen] = info
+
+        return [infos[board.fen()] for board in boards]
+
+def analyze_pgn_with_stockfish(pgn_stream: TextIO, engine_path: str, opening_book: OpeningBook) -> Dict:
+    game = chess.pgn.read_game(pgn_stream)
     
     if not game:
         return {"error": "No game found in the PGN file."}
@@ -155,7 +302,7 @@ def analyze_pgn_with_stockfish(pgn_file: str, engine_path: str, book_csv: str) -
         "player_summaries": {}
     }
     
-    with chess.engine.SimpleEngine.popen_uci(engine_path) as engine:
+    with EnginePool(engine_path) as pool:
         board = game.board()
         classifications = {
             "white": {phase: [] for phase in GamePhase},
@@ -164,22 +311,57 @@ def analyze_pgn_with_stockfish(pgn_file: str, engine_path: str, book_csv: str) -
         phase_data = {phase: [] for phase in GamePhase}
         in_opening = True
 
+        # Walk the game once to collect every position and which moves are
+        # book moves. Book moves are classified without searching.
+        positions = [board.copy()]
+        book_moves = []
+        for node in game.mainline():
+            board.push(node.move)
+            positions.append(board.copy())
+            book_moves.append(is_book_move(board, opening_book))
+        board = game.board()
+        searched_plies = [ply for ply, book_move in enumerate(book_moves) if not book_move]
+
+        # Search the positions around every other move in parallel at a
+        # shallow depth first. The position after each move is the position
+        # before the next one, so each is searched only once.
+        searched = sorted({i for ply in searched_plies for i in (ply, ply + 1)})
+        shallow_infos = dict(zip(searched, pool.analyse_many([positions[i] for i in searched], SHALLOW_ANALYSIS_DEPTH)))
+
+        # Only moves whose evaluation loss lands close to a classification
+        # boundary are searched again at full depth. The deep results are kept
+        # apart so every move compares two evals taken at the same depth.
+        deeper_plies = set()
+        for ply in searched_plies:
+            pre_eval = white_eval(shallow_infos[ply])
+            if near_classification_boundary(pre_eval, abs(pre_eval - white_eval(shallow_infos[ply + 1]))):
+                deeper_plies.add(ply)
+        deeper = sorted({i for ply in deeper_plies for i in (ply, ply + 1)})
+        deep_infos = dict(zip(deeper, pool.analyse_many([positions[i] for i in deeper], ANALYSIS_DEPTH)))
+
+        post_eval = 0
         for move_number, node in enumerate(game.mainline(), start=1):
-            # Analyze position before the move
-            pre_info = engine.analyse(board, chess.engine.Limit(depth=20))
-            pre_eval = pre_info["score"].white().score(mate_score=10000) or 0
-            best_move = pre_info.get("pv", [None])[0]
-            
+            book_move = book_moves[move_number - 1]
+            infos = deep_infos if move_number - 1 in deeper_plies else shallow_infos
+            if not book_move:
+                # Analysis of the position before the move
+                pre_info = infos[move_number - 1]
+                pre_eval = white_eval(pre_info)
+                best_move = pre_info.get("pv", [None])[0]
+            else:
+                # Book moves keep the previous move's evaluation
+                pre_eval = post_eval
+
             # Make the move
             move = node.move
             board.push(move)
             
-            # Analyze position after the move
-            post_info = engine.analyse(board, chess.engine.Limit(depth=20))
-            post_eval = post_info["score"].white().score(mate_score=10000) or 0
+            # Analysis of the position after the move
+            if not book_move:
+                post_info = infos[move_number]
+                post_eval = white_eval(post_info)
             
             # Determine game phase
-            book_move = is_book_move(board, opening_book)
             current_phase = detect_game_phase(board, in_opening)
             if not book_move and in_opening:
                 in_opening = False
@@ -190,25 +372,20 @@ def analyze_pgn_with_stockfish(pgn_file: str, engine_path: str, book_csv: str) -
             # Initial classification
             classification = Classification.BOOK if book_move else None
             if not classification:
-                for classif in centipawn_classifications:
-                    threshold = get_evaluation_loss_threshold(classif, pre_eval)
-                    if eval_loss <= threshold:
-                        classification = classif
-                        break
-                classification = classification or Classification.BLUNDER
+                classification = classify_eval_loss(pre_eval, eval_loss)
 
-            # Check for missed opportunities
-            is_winning = abs(pre_eval) >= FORCED_WIN_THRESHOLD
-            is_forced_win = pre_info["score"].is_mate() and pre_info["score"].relative.mate() <= MISS_MATE_THRESHOLD
-            if is_winning and move != best_move and (eval_loss >= MISS_CENTIPAWN_LOSS or is_forced_win):
-                classification = Classification.MISS
+                # Check for missed opportunities
+                is_winning = abs(pre_eval) >= FORCED_WIN_THRESHOLD
+                is_forced_win = pre_info["score"].is_mate() and pre_info["score"].relative.mate() <= MISS_MATE_THRESHOLD
+                if is_winning and move != best_move and (eval_loss >= MISS_CENTIPAWN_LOSS or is_forced_win):
+                    classification = Classification.MISS
 
-            # Check for brilliant moves
-            if classification == Classification.BEST:
-                if pre_eval < -150 and post_eval >= 150:
-                    classification = Classification.GREAT
-                elif pre_eval < -300 and post_eval >= 300:
-                    classification = Classification.BRILLIANT
+                # Check for brilliant moves
+                if classification == Classification.BEST:
+                    if pre_eval < -150 and post_eval >= 150:
+                        classification = Classification.GREAT
+                    elif pre_eval < -300 and post_eval >= 300:
+                        classification = Classification.BRILLIANT
 
             # Track classifications
             player = "white" if board.turn == chess.BLACK else "black"
@@ -269,20 +446,91 @@ def get_phase_rating(classified_moves: List[Classification]) -> Classification:
     
     return next((c for c, t in rating_order if average >= t), Classification.BLUNDER)
 
+def file_mtime(path: str):
+    """Modification time of a file, or of an executable found on PATH, or None."""
+    try:
+        return os.path.getmtime(shutil.which(path) or path)
+    except OSError:
+        return None
+
+def result_digest(pgn_bytes: bytes, engine_path: str, book_csv: str) -> str:
+    """Key a game's analysis by its PGN and everything else that affects the result."""
+    digest = hashlib.blake2b(pgn_bytes, digest_size=16)
+    # The mtimes make edited books and replaced engine binaries miss the cache
+    digest.update(f"\0{RESULT_CACHE_VERSION}\0{engine_path}\0{file_mtime(engine_path)}\0{book_csv}\0{file_mtime(book_csv)}"
+                  f"\0{SHALLOW_ANALYSIS_DEPTH}\0{ANALYSIS_DEPTH}".encode())
+    return digest.hexdigest()
+
+def load_cached_result(digest: str):
+    """Return a previously computed analysis from memory or disk, or None."""
+    if digest in result_cache:
+        result_cache.move_to_end(digest)
+        return result_cache[digest]
+    try:
+        with open(os.path.join(RESULT_CACHE_DIR, f"{digest}.json"), encoding="utf-8") as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        return None
+    remember_result(digest, result)
+    return result
+
+def remember_result(digest: str, result: Dict):
+    result_cache[digest] = result
+    if len(result_cache) > RESULT_CACHE_SIZE:
+        result_cache.popitem(last=False)
+
+def store_result(digest: str, result: Dict):
+    """Cache an analysis in memory and write it to disk atomically."""
+    remember_result(digest, result)
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=RESULT_CACHE_DIR, suffix=".tmp", delete=False, encoding="utf-8") as tmp_file:
+            json.dump(result, tmp_file)
+        os.replace(tmp_file.name, os.path.join(RESULT_CACHE_DIR, f"{digest}.json"))
+    except OSError as e:
+        print(f"Error caching analysis result: {e}")
+
+@app.on_event("startup")
+def load_default_opening_book():
+    # Books are kept with the mtime they were loaded at
+    app.state.opening_books = {DEFAULT_BOOK: (file_mtime(DEFAULT_BOOK), get_opening_book(DEFAULT_BOOK))}
+
+def close_opening_book(opening_book: OpeningBook):
+    if isinstance(opening_book, chess.polyglot.MemoryMappedReader):
+        opening_book.close()
+
+@app.on_event("shutdown")
+def close_opening_books():
+    for _, opening_book in app.state.opening_books.values():
+        close_opening_book(opening_book)
+
+def opening_book_for(book_csv: str) -> OpeningBook:
+    """The loaded book for a path, reloaded once the file has changed."""
+    opening_books = app.state.opening_books
+    mtime = file_mtime(book_csv)
+    if book_csv in opening_books and opening_books[book_csv][0] != mtime:
+        close_opening_book(opening_books.pop(book_csv)[1])
+    if book_csv not in opening_books:
+        opening_books[book_csv] = (mtime, get_opening_book(book_csv))
+    return opening_books[book_csv][1]
+
 @app.post("/analyze-pgn/")
-async def analyze_pgn(pgn_file: UploadFile = File(...), engine_path: str = "stockfish-windows-x86-64.exe", book_csv: str = "openings_master.csv"):
+async def analyze_pgn(pgn_file: UploadFile = File(...), engine_path: str = "stockfish-windows-x86-64.exe", book_csv: str = DEFAULT_BOOK):
     try:
-        # Save the uploaded file to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pgn") as tmp_file:
-            tmp_file.write(await pgn_file.read())
-            tmp_file_path = tmp_file.name
+        pgn_bytes = await pgn_file.read()
 
-        # Analyze the PGN file
-        analysis_result = analyze_pgn_with_stockfish(tmp_file_path, engine_path, book_csv)
+        # Return the stored analysis if this game has been analysed before
+        digest = result_digest(pgn_bytes, engine_path, book_csv)
+        cached_result = load_cached_result(digest)
+        if cached_result is not None:
+            return cached_result
 
-        # Clean up the temporary file
-        os.remove(tmp_file_path)
+        # Analyze the PGN straight from the uploaded bytes
+        pgn_stream = io.StringIO(pgn_bytes.decode("utf-8", errors="replace"))
+        analysis_result = analyze_pgn_with_stockfish(pgn_stream, engine_path, opening_book_for(book_csv))
 
+        if "error" not in analysis_result:
+            store_result(digest, analysis_result)
         return analysis_result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,13 +1,28 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
+import asyncio
 import os
 import tempfile
 import chess
 import chess.engine
-import chess.pgn
+import numpy as np
 from enum import Enum
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import csv
 import json
+import re
+import pickle
+import queue
+import hashlib
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 app = FastAPI()
 
@@ -47,6 +62,31 @@ classification_values = {
     Classification.FORCED: 1,
 }
 
+# Classifications are stored as their index in enum order. Scores are kept
+# in twentieths so phase averages compare exactly against the thresholds
+SCORE_SCALE = 20
+CLASSIFICATIONS = list(Classification)
+CLASSIFICATION_CODES = {c: code for code, c in enumerate(CLASSIFICATIONS)}
+CLASSIFICATION_SCORES = np.array([round(classification_values[c] * SCORE_SCALE) for c in CLASSIFICATIONS])
+
+PLAYERS = ["white", "black"]
+GAME_PHASES = list(GamePhase)
+PHASE_INDICES = {phase: index for index, phase in enumerate(GAME_PHASES)}
+
+# Phase ratings from worst to best, and the average score each one needs
+PHASE_RATINGS = [
+    Classification.BLUNDER,
+    Classification.MISTAKE,
+    Classification.MISS,
+    Classification.INACCURACY,
+    Classification.GOOD,
+    Classification.EXCELLENT,
+    Classification.BEST,
+    Classification.GREAT,
+    Classification.BRILLIANT,
+]
+PHASE_RATING_THRESHOLDS = np.rint(np.array([0.15, 0.25, 0.35, 0.5, 0.65, 0.75, 0.85, 0.95]) * SCORE_SCALE).astype(int)
+
 centipawn_classifications = [
     Classification.BEST,
     Classification.EXCELLENT,
@@ -56,6 +96,18 @@ centipawn_classifications = [
     Classification.MISTAKE,
     Classification.BLUNDER,
 ]
+CENTIPAWN_CODES = np.array([CLASSIFICATION_CODES[c] for c in centipawn_classifications])
+
+# Quadratic coefficients (a, b, c) of the eval-loss threshold a*p^2 + b*p + c,
+# p = |previous eval|, for each of centipawn_classifications but BLUNDER
+THRESHOLD_COEFFS = np.array([
+    [0.0001, 0.0236, -3.7143],
+    [0.0002, 0.1231, 27.5455],
+    [0.0002, 0.2643, 60.5455],
+    [0.0002, 0.3624, 108.0909],
+    [0.00025, 0.38255, 166.9541],
+    [0.0003, 0.4027, 225.8182],
+])
 
 # Analysis parameters
 FORCED_WIN_THRESHOLD = 500
@@ -63,59 +115,142 @@ MISS_CENTIPAWN_LOSS = 300
 MISS_MATE_THRESHOLD = 3
 ENDGAME_MATERIAL_THRESHOLD = 24
 QUEEN_VALUE = 9
+# Material value indexed by piece type (chess.PAWN .. chess.KING)
+PIECE_VALUES = (0, 1, 3, 3, 5, QUEEN_VALUE, 0)
+MATERIAL_PIECE_TYPES = (chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN)
+
+# Engine pool: independent positions are analysed in parallel by
+# ENGINE_POOL_SIZE Stockfish processes sharing the machine's cores
+ENGINE_POOL_SIZE = min(os.cpu_count() or 1, 4)
+ENGINE_THREADS = max(1, (os.cpu_count() or 1) // ENGINE_POOL_SIZE)
+ENGINE_HASH_MB = 64
+# Requests are analysed off the event loop and may overlap; only one engine
+# pool runs at a time so concurrent games cannot oversubscribe the cores
+engine_pool_slot = threading.BoundedSemaphore(1)
+ANALYSIS_DEPTH = 20
+# Node cap so a pathological position cannot stall a search at ANALYSIS_DEPTH
+MAX_NODES = 5_000_000
+
+# A move number glued to the front of a token ("1.", "1.e4", "12...Nf6", "...")
+MOVE_NUMBER_RE = re.compile(r'^\d*\.+')
+# Game results, which end a movetext but are not moves
+RESULT_RE = re.compile(r'^(?:1-0|0-1|1/2-1/2|\*)$')
+# Annotation suffixes ("!", "?!", "!!") that push_san does not accept
+ANNOTATION_RE = re.compile(r'[!?]+$')
+# Comments and NAGs, and variations without nested ones, which are not mainline moves
+COMMENT_RE = re.compile(r'\{[^}]*\}|\$\d+')
+VARIATION_RE = re.compile(r'\([^()]*\)')
+
+DEFAULT_BOOK_CSV = "openings_master.csv"
+# Bump when the pickled opening book layout changes
+BOOK_CACHE_VERSION = 5
+
+# Finished analyses are kept in memory (most recent RESULT_CACHE_SIZE) and on disk
+RESULT_CACHE_DIR = "result_cache"
+RESULT_CACHE_SIZE = 128
+result_cache = OrderedDict()
+# Bump when the analysis logic or the result format changes to invalidate cached results
+RESULT_CACHE_VERSION = 1
 
 # ---------------------------------------------------------------------------
 # Helper Functions
 # ---------------------------------------------------------------------------
 
-def detect_game_phase(board: chess.Board, in_opening: bool) -> GamePhase:
+def count_material(board: chess.Board) -> Tuple[int, int]:
+    """Total material of both sides and the number of queens on the board."""
+    total_material = 0
+    for color in (chess.WHITE, chess.BLACK):
+        for piece_type in MATERIAL_PIECE_TYPES:
+            total_material += PIECE_VALUES[piece_type] * chess.popcount(board.pieces_mask(piece_type, color))
+    return total_material, chess.popcount(board.queens)
+
+def material_change(board: chess.Board, move: chess.Move) -> Tuple[int, int]:
+    """How a move, not yet pushed, changes count_material(board)."""
+    material = queens = 0
+    if board.is_en_passant(move):
+        material -= PIECE_VALUES[chess.PAWN]
+    else:
+        captured = board.piece_type_at(move.to_square)
+        if captured:
+            material -= PIECE_VALUES[captured]
+            queens -= captured == chess.QUEEN
+    if move.promotion:
+        material += PIECE_VALUES[move.promotion] - PIECE_VALUES[chess.PAWN]
+        queens += move.promotion == chess.QUEEN
+    return material, queens
+
+def detect_game_phase(total_material: int, queens: int, in_opening: bool) -> GamePhase:
     if in_opening:
         return GamePhase.OPENING
 
-    total_material = 0
-    queens = 0
-
-    for color in [chess.WHITE, chess.BLACK]:
-        for piece_type in chess.PIECE_TYPES:
-            if piece_type == chess.KING:
-                continue
-            count = len(board.pieces(piece_type, color))
-            value = {
-                chess.PAWN: 1,
-                chess.KNIGHT: 3,
-                chess.BISHOP: 3,
-                chess.ROOK: 5,
-                chess.QUEEN: QUEEN_VALUE
-            }[piece_type]
-            total_material += count * value
-            if piece_type == chess.QUEEN:
-                queens += count
-
     endgame_conditions = [
         total_material <= ENDGAME_MATERIAL_THRESHOLD,
         queens == 0 and total_material <= ENDGAME_MATERIAL_THRESHOLD * 2,
     ]
     return GamePhase.ENDGAME if any(endgame_conditions) else GamePhase.MIDDLEGAME
 
-def get_evaluation_loss_threshold(classif: Classification, prev_eval: float) -> float:
-    prev_eval = abs(prev_eval)
-    if classif == Classification.BEST:
-        return max(0.0001 * prev_eval**2 + 0.0236 * prev_eval - 3.7143, 0)
-    elif classif == Classification.EXCELLENT:
-        return max(0.0002 * prev_eval**2 + 0.1231 * prev_eval + 27.5455, 0)
-    elif classif == Classification.GOOD:
-        return max(0.0002 * prev_eval**2 + 0.2643 * prev_eval + 60.5455, 0)
-    elif classif == Classification.INACCURACY:
-        return max(0.0002 * prev_eval**2 + 0.3624 * prev_eval + 108.0909, 0)
-    elif classif == Classification.MISS:
-        return max(0.00025 * prev_eval**2 + 0.38255 * prev_eval + 166.9541, 0)
-    elif classif == Classification.MISTAKE:
-        return max(0.0003 * prev_eval**2 + 0.4027 * prev_eval + 225.8182, 0)
-    else:
-        return float("inf")
+def evaluation_loss_thresholds(eval_magnitudes: np.ndarray) -> np.ndarray:
+    """
+    Upper eval-loss bound of each classification in centipawn_classifications
+    but BLUNDER, one row per absolute evaluation before a move.
+    """
+    a, b, c = THRESHOLD_COEFFS.T
+    return np.maximum(np.outer(eval_magnitudes * eval_magnitudes, a) + np.outer(eval_magnitudes, b) + c, 0)
 
-def load_opening_book(csv_path: str) -> Dict[str, str]:
+def classify_moves(pre_evals: np.ndarray, post_evals: np.ndarray, book_moves: np.ndarray,
+                   missed_best_moves: np.ndarray, forced_wins: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Classify every move of a game at once from the white evaluations before
+    and after it. Returns the classification codes and the eval losses.
+    """
+    eval_losses = np.abs(pre_evals - post_evals)
+    pre_magnitudes = np.abs(pre_evals)
+
+    # Thresholds grow with each classification, so the number of them below
+    # the loss is the move's index in centipawn_classifications; past the
+    # last one it is a blunder
+    thresholds = evaluation_loss_thresholds(pre_magnitudes)
+    codes = CENTIPAWN_CODES[(eval_losses[:, None] > thresholds).sum(axis=1)]
+    codes[book_moves] = CLASSIFICATION_CODES[Classification.BOOK]
+
+    # Check for missed opportunities
+    is_winning = pre_magnitudes >= FORCED_WIN_THRESHOLD
+    missed = is_winning & missed_best_moves & ((eval_losses >= MISS_CENTIPAWN_LOSS) | forced_wins)
+    codes[missed] = CLASSIFICATION_CODES[Classification.MISS]
+
+    # Check for brilliant moves
+    best = codes == CLASSIFICATION_CODES[Classification.BEST]
+    great = best & (pre_evals < -150) & (post_evals >= 150)
+    brilliant = best & ~great & (pre_evals < -300) & (post_evals >= 300)
+    codes[great] = CLASSIFICATION_CODES[Classification.GREAT]
+    codes[brilliant] = CLASSIFICATION_CODES[Classification.BRILLIANT]
+    return codes, eval_losses
+
+def san_tokens(text: str) -> List[str]:
+    """The mainline move tokens of a movetext, skipping comments, NAGs and variations.
+
+    Tokens are kept whole, so long algebraic and UCI moves reach push_san
+    intact and anything unparseable is reported there as an invalid move.
+    """
+    text = COMMENT_RE.sub(" ", text)
+    # Variations can nest, so drop the innermost ones until none are left
+    while True:
+        text, removed = VARIATION_RE.subn(" ", text)
+        if not removed:
+            break
+    tokens = []
+    for token in text.split():
+        token = ANNOTATION_RE.sub("", MOVE_NUMBER_RE.sub("", token))
+        if token and not RESULT_RE.match(token):
+            tokens.append(token)
+    return tokens
+
+# Book lines as a trie: each node maps the UCI of a book move to the node after it
+OpeningTrie = Dict[str, dict]
+
+def load_opening_book(csv_path: str) -> OpeningTrie:
     opening_book = {}
+    board = chess.Board()
     try:
         with open(csv_path, newline='', encoding='utf-8') as csvfile:
             reader = csv.reader(csvfile)
@@ -123,55 +258,107 @@ def load_opening_book(csv_path: str) -> Dict[str, str]:
             for row in reader:
                 if len(row) < 3:
                     continue
-                pgn_moves = row[2]
-                game = chess.pgn.Game()
-                board = game.board()
-                for move in pgn_moves.split():
-                    if "." in move:
-                        continue
+                board.reset()
+                book_node = opening_book
+                for token in san_tokens(row[2]):
                     try:
-                        chess_move = board.push_san(move)
-                        fen = " ".join(board.fen().split()[:4])
-                        opening_book[fen] = chess_move.uci()
+                        move = board.parse_san(token)
                     except ValueError:
                         break
+                    board.push(move)
+                    book_node = book_node.setdefault(move.uci(), {})
     except Exception as e:
         print(f"Error loading opening book: {e}")
     return opening_book
 
-def is_book_move(board: chess.Board, opening_book: Dict[str, str], max_depth: int = 8) -> str:
-    if board.fullmove_number > max_depth:
+def get_opening_book(csv_path: str) -> OpeningTrie:
+    """Load the opening book, reusing a pickled copy while the CSV is unchanged."""
+    cache_path = csv_path + ".pkl"
+    try:
+        mtime = os.path.getmtime(csv_path)
+    except OSError as e:
+        print(f"Error loading opening book: {e}")
+        return {}
+
+    try:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+        if cached["version"] == BOOK_CACHE_VERSION and cached["mtime"] == mtime:
+            return cached["book"]
+    except Exception:
+        pass
+
+    opening_book = load_opening_book(csv_path)
+    if opening_book:
+        try:
+            with open(cache_path, "wb") as f:
+                pickle.dump({"version": BOOK_CACHE_VERSION, "mtime": mtime, "book": opening_book}, f)
+        except OSError as e:
+            print(f"Error caching opening book: {e}")
+    return opening_book
+
+def follow_book(book_node: Optional[OpeningTrie], move: chess.Move) -> Optional[OpeningTrie]:
+    """The book node reached by playing move, or None once the game has left the book."""
+    if book_node is None:
         return None
-    fen = " ".join(board.fen().split()[:4])
-    return opening_book.get(fen)
+    return book_node.get(move.uci())
+
+def is_book_move(board: chess.Board, book_node: Optional[OpeningTrie], max_depth: int = 8) -> bool:
+    return book_node is not None and board.fullmove_number <= max_depth
 
-def get_phase_rating(classified_moves: List[Classification]) -> Classification:
-    if not classified_moves:
+def analyse_positions(engine_path: str, boards: List[chess.Board]) -> Dict[tuple, Dict]:
+    """
+    Analyse every distinct position once, spread across a pool of Stockfish
+    engines. Results are keyed by board._transposition_key().
+    """
+    unique_boards = {}
+    for board in boards:
+        unique_boards.setdefault(board._transposition_key(), board)
+
+    pool_size = min(ENGINE_POOL_SIZE, len(unique_boards))
+    idle_engines = queue.Queue()
+    engines = []
+    with engine_pool_slot:
+        try:
+            for _ in range(pool_size):
+                engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+                engines.append(engine)
+                engine.configure({"Threads": ENGINE_THREADS, "Hash": ENGINE_HASH_MB})
+                idle_engines.put(engine)
+
+            def analyse(board: chess.Board) -> Dict:
+                engine = idle_engines.get()
+                try:
+                    return engine.analyse(board, chess.engine.Limit(depth=ANALYSIS_DEPTH, nodes=MAX_NODES))
+                finally:
+                    idle_engines.put(engine)
+
+            with ThreadPoolExecutor(max_workers=max(pool_size, 1)) as executor:
+                return dict(zip(unique_boards, executor.map(analyse, unique_boards.values())))
+        finally:
+            for engine in engines:
+                engine.quit()
+
+def get_phase_rating(classification_counts: np.ndarray) -> Classification:
+    """Rate a phase from how many of its moves got each classification code."""
+    move_count = classification_counts.sum()
+    if not move_count:
         return Classification.GOOD
-    total = sum(classification_values[m] for m in classified_moves)
-    average = total / len(classified_moves)
-    rating_order = [
-        (Classification.BRILLIANT, 0.95),
-        (Classification.GREAT, 0.85),
-        (Classification.BEST, 0.75),
-        (Classification.EXCELLENT, 0.65),
-        (Classification.GOOD, 0.5),
-        (Classification.INACCURACY, 0.35),
-        (Classification.MISS, 0.25),
-        (Classification.MISTAKE, 0.15)
-    ]
-    return next((c for c, t in rating_order if average >= t), Classification.BLUNDER)
+    total = CLASSIFICATION_SCORES @ classification_counts
+    # The best rating whose threshold the average score reaches, compared
+    # as total >= threshold * count to stay in integers
+    thresholds = PHASE_RATING_THRESHOLDS * move_count
+    return PHASE_RATINGS[np.searchsorted(thresholds, total, side="right")]
 
 # ---------------------------------------------------------------------------
 # Analysis Function for JSON Games
 # ---------------------------------------------------------------------------
 
-def analyze_json_game_with_stockfish(game_json: Dict, engine_path: str, book_csv: str) -> Dict:
+def analyze_json_game_with_stockfish(game_json: Dict, engine_path: str, opening_book: OpeningTrie) -> Dict:
     """
     Analyze a chess game provided as a JSON object with metadata and a "Moves" list.
     Each move in the "Moves" list is a string (e.g., "1. Nf3 d6").
     """
-    opening_book = load_opening_book(book_csv)
     board = chess.Board()
     result = {
         "move_analysis": [],
@@ -179,137 +366,240 @@ def analyze_json_game_with_stockfish(game_json: Dict, engine_path: str, book_csv
         "player_summaries": {},
         "game_info": game_json  # echoing back the game metadata
     }
-    classifications = {
-        "white": {phase: [] for phase in GamePhase},
-        "black": {phase: [] for phase in GamePhase}
-    }
-    phase_data = {phase: [] for phase in GamePhase}
     in_opening = True
     move_number = 1
 
-    with chess.engine.SimpleEngine.popen_uci(engine_path) as engine:
-        # Process each move line from the "Moves" list.
-        # Each move line might contain one or two moves.
-        for move_line in game_json.get("Moves", []):
-            tokens = move_line.split()
-            # Remove move number tokens (ending with a period)
-            move_tokens = [token for token in tokens if not token.endswith('.')]
-            for token in move_tokens:
-                # Analyze position before making the move
-                pre_info = engine.analyse(board, chess.engine.Limit(depth=20))
-                pre_eval = pre_info["score"].white().score(mate_score=10000) or 0
-                best_move = pre_info.get("pv", [None])[0]
-                
-                try:
-                    board.push_san(token)
-                except ValueError as e:
-                    # Skip invalid moves with an error note
-                    result["move_analysis"].append({
-                        "move_number": move_number,
-                        "player": "unknown",
-                        "move": token,
-                        "error": f"Invalid move: {e}"
-                    })
-                    continue
+    # Split the joined "Moves" lines into mainline move tokens once, before replaying them
+    tokens = san_tokens(" ".join(game_json.get("Moves", [])))
+
+    # First pass: replay the moves to find the book moves and collect the
+    # positions around every other move, then analyse those in parallel.
+    # Book moves are classified without searching. The position after a
+    # move is the position before the next one, so each is searched once.
+    plies = []
+    positions = []
+    # The game stays in the book only while every move follows a book line
+    book_node = opening_book
+    # Whether the current position is already the last one collected
+    collected = False
+    for token in tokens:
+        try:
+            move = board.push_san(token)
+        except ValueError as e:
+            plies.append((token, None, e, None))
+            continue
+        book_node = follow_book(book_node, move)
+        book_move = is_book_move(board, book_node)
+        plies.append((token, move, None, book_move))
+        if book_move:
+            collected = False
+            continue
+        if not collected:
+            # The position before this move follows a book move (or is
+            # the starting position), so it has not been collected yet
+            pre_board = board.copy()
+            pre_board.pop()
+            positions.append(pre_board)
+        positions.append(board.copy())
+        collected = True
+    analyses = analyse_positions(engine_path, positions)
+    # Every position but the first and last is both after one move and
+    # before the next, so take its white evaluation once
+    white_evals = {key: info["score"].white().score(mate_score=10000) or 0 for key, info in analyses.items()}
+
+    # Second pass: gather what classification needs about every move
+    board = chess.Board()
+    total_material, queens = count_material(board)
+    pre_evals, post_evals, book_moves, missed_best_moves, forced_wins = [], [], [], [], []
+    player_indices, phase_indices, move_entries = [], [], []
+    post_eval = 0
+    for token, move, error, book_move in plies:
+        if error is not None:
+            # Skip invalid moves with an error note
+            result["move_analysis"].append({
+                "move_number": move_number,
+                "player": "unknown",
+                "move": token,
+                "error": f"Invalid move: {error}"
+            })
+            continue
+
+        if book_move:
+            # Book moves keep the previous move's evaluation
+            pre_eval = post_eval
+            missed_best_move = forced_win = False
+        else:
+            # Analysis of the position before making the move
+            pre_key = board._transposition_key()
+            pre_info = analyses[pre_key]
+            pre_score = pre_info["score"]
+            pre_eval = white_evals[pre_key]
+            best_move = pre_info.get("pv", [None])[0]
+            missed_best_move = move != best_move
+            forced_win = pre_score.is_mate() and pre_score.relative.mate() <= MISS_MATE_THRESHOLD
+
+        material_delta, queen_delta = material_change(board, move)
+        total_material += material_delta
+        queens += queen_delta
+        board.push(move)
+
+        if not book_move:
+            # Analysis of the position after the move
+            post_eval = white_evals[board._transposition_key()]
+
+        # Determine game phase
+        current_phase = detect_game_phase(total_material, queens, in_opening)
+        if not book_move and in_opening:
+            in_opening = False
+
+        pre_evals.append(pre_eval)
+        post_evals.append(post_eval)
+        book_moves.append(bool(book_move))
+        missed_best_moves.append(missed_best_move)
+        forced_wins.append(forced_win)
+
+        # Determine which player made the move (after push, board.turn points to opponent)
+        player = "white" if board.turn == chess.BLACK else "black"
+        player_indices.append(PLAYERS.index(player))
+        phase_indices.append(PHASE_INDICES[current_phase])
+
+        # The eval loss and classification are filled in below
+        move_entry = {
+            "move_number": move_number,
+            "player": "White" if player == "white" else "Black",
+            "move": token,
+            "evaluation": post_eval / 100,
+        }
+        result["move_analysis"].append(move_entry)
+        move_entries.append(move_entry)
+        move_number += 1
+
+    # Classify all moves at once
+    codes, eval_losses = classify_moves(
+        np.array(pre_evals, dtype=np.int64),
+        np.array(post_evals, dtype=np.int64),
+        np.array(book_moves, dtype=bool),
+        np.array(missed_best_moves, dtype=bool),
+        np.array(forced_wins, dtype=bool),
+    )
+    for move_entry, code, eval_loss in zip(move_entries, codes.tolist(), eval_losses.tolist()):
+        move_entry["evaluation_loss"] = eval_loss / 100
+        move_entry["classification"] = CLASSIFICATIONS[code].value
+
+    # Moves per [player, phase, classification code]
+    counts = np.zeros((len(PLAYERS), len(GAME_PHASES), len(CLASSIFICATIONS)), dtype=np.int32)
+    np.add.at(counts, (player_indices, phase_indices, codes), 1)
+
+    # Phase analysis report
+    phase_counts = counts.sum(axis=0)
+    for phase, classification_counts in zip(GAME_PHASES, phase_counts):
+        move_count = int(classification_counts.sum())
+        if move_count:
+            rating = get_phase_rating(classification_counts)
+            result["phase_analysis"][phase.value] = {
+                "rating": rating.value,
+                "move_count": move_count
+            }
+
+    # Player summaries report
+    player_counts = counts.sum(axis=1)
+    for color, classification_counts in zip(PLAYERS, player_counts):
+        player_name = game_json.get("White") if color == "white" else game_json.get("Black")
+        result["player_summaries"][player_name] = dict(zip((c.value for c in CLASSIFICATIONS), classification_counts.tolist()))
+
+    return result
+
+# ---------------------------------------------------------------------------
+# Result Cache
+# ---------------------------------------------------------------------------
 
-                # Analyze position after the move
-                post_info = engine.analyse(board, chess.engine.Limit(depth=20))
-                post_eval = post_info["score"].white().score(mate_score=10000) or 0
-
-                # Determine game phase and opening book move
-                book_move = is_book_move(board, opening_book)
-                current_phase = detect_game_phase(board, in_opening)
-                if not book_move and in_opening:
-                    in_opening = False
-
-                eval_loss = abs(pre_eval - post_eval)
-
-                # Initial classification
-                classification = Classification.BOOK if book_move else None
-                if not classification:
-                    for classif in centipawn_classifications:
-                        threshold = get_evaluation_loss_threshold(classif, pre_eval)
-                        if eval_loss <= threshold:
-                            classification = classif
-                            break
-                    if classification is None:
-                        classification = Classification.BLUNDER
-
-                # Check for missed opportunities
-                is_winning = abs(pre_eval) >= FORCED_WIN_THRESHOLD
-                is_forced_win = pre_info["score"].is_mate() and pre_info["score"].relative.mate() <= MISS_MATE_THRESHOLD
-                if is_winning and token != (best_move.uci() if best_move else None) and (eval_loss >= MISS_CENTIPAWN_LOSS or is_forced_win):
-                    classification = Classification.MISS
-
-                # Check for brilliant moves
-                if classification == Classification.BEST:
-                    if pre_eval < -150 and post_eval >= 150:
-                        classification = Classification.GREAT
-                    elif pre_eval < -300 and post_eval >= 300:
-                        classification = Classification.BRILLIANT
-
-                # Determine which player made the move (after push, board.turn points to opponent)
-                player = "white" if board.turn == chess.BLACK else "black"
-                classifications[player][current_phase].append(classification)
-                phase_data[current_phase].append(classification)
-
-                result["move_analysis"].append({
-                    "move_number": move_number,
-                    "player": "White" if player == "white" else "Black",
-                    "move": token,
-                    "evaluation": post_eval / 100,
-                    "evaluation_loss": eval_loss / 100,
-                    "classification": classification.value
-                })
-                move_number += 1
-
-        # Phase analysis report
-        for phase in GamePhase:
-            moves = phase_data[phase]
-            if moves:
-                rating = get_phase_rating(moves)
-                result["phase_analysis"][phase.value] = {
-                    "rating": rating.value,
-                    "move_count": len(moves)
-                }
-
-        # Player summaries report
-        for color in ["white", "black"]:
-            player_name = game_json.get("White") if color == "white" else game_json.get("Black")
-            counts = {c.value: 0 for c in Classification}
-            for phase in GamePhase:
-                for m in classifications[color][phase]:
-                    counts[m.value] += 1
-            result["player_summaries"][player_name] = counts
+def file_mtime(path: str):
+    """Modification time of a file, or of an executable found on PATH, or None."""
+    try:
+        return os.path.getmtime(shutil.which(path) or path)
+    except OSError:
+        return None
 
+def result_digest(game_json: Dict, engine_path: str, book_csv: str) -> str:
+    """Key a game's analysis by its JSON and everything else that affects the result."""
+    # The metadata is echoed back in the result, so the whole game is hashed
+    game_bytes = json.dumps(game_json, sort_keys=True, separators=(",", ":")).encode()
+    digest = hashlib.blake2b(game_bytes, digest_size=16)
+    # The mtimes make edited books and replaced engine binaries miss the cache
+    digest.update(f"\0{RESULT_CACHE_VERSION}\0{engine_path}\0{file_mtime(engine_path)}\0{book_csv}\0{file_mtime(book_csv)}"
+                  f"\0{ANALYSIS_DEPTH}\0{MAX_NODES}".encode())
+    return digest.hexdigest()
+
+def load_cached_result(digest: str):
+    """Return a previously computed analysis from memory or disk, or None."""
+    if digest in result_cache:
+        result_cache.move_to_end(digest)
+        return result_cache[digest]
+    try:
+        with open(os.path.join(RESULT_CACHE_DIR, f"{digest}.json"), "rb") as f:
+            result = json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+    remember_result(digest, result)
     return result
 
+def remember_result(digest: str, result: Dict):
+    result_cache[digest] = result
+    if len(result_cache) > RESULT_CACHE_SIZE:
+        result_cache.popitem(last=False)
+
+def store_result(digest: str, result: Dict):
+    """Cache an analysis in memory and write it to disk atomically."""
+    remember_result(digest, result)
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=RESULT_CACHE_DIR, suffix=".tmp", delete=False, encoding="utf-8") as tmp_file:
+            json.dump(result, tmp_file)
+        os.replace(tmp_file.name, os.path.join(RESULT_CACHE_DIR, f"{digest}.json"))
+    except OSError as e:
+        print(f"Error caching analysis result: {e}")
+
 # ---------------------------------------------------------------------------
 # FastAPI Endpoint
 # ---------------------------------------------------------------------------
 
-@app.post("/analyze-pgn/")
-async def analyze_pgn(json_file: UploadFile = File(...), engine_path: str = "stockfish-windows-x86-64.exe", book_csv: str = "openings_master.csv"):
-    try:
-        # Save the uploaded JSON file to a temporary file
-        contents = await json_file.read()
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".json") as tmp_file:
-            tmp_file.write(contents)
-            tmp_file_path = tmp_file.name
+@app.on_event("startup")
+def load_default_opening_book():
+    # Books are kept with the mtime they were loaded at
+    app.state.opening_books = {DEFAULT_BOOK_CSV: (file_mtime(DEFAULT_BOOK_CSV), get_opening_book(DEFAULT_BOOK_CSV))}
 
-        # Load the JSON file
-        with open(tmp_file_path, 'r', encoding="utf-8") as f:
-            game_data = json.load(f)
+def opening_book_for(book_csv: str) -> OpeningTrie:
+    """The loaded book for a path, reloaded once the file has changed."""
+    opening_books = app.state.opening_books
+    mtime = file_mtime(book_csv)
+    if book_csv not in opening_books or opening_books[book_csv][0] != mtime:
+        opening_books[book_csv] = (mtime, get_opening_book(book_csv))
+    return opening_books[book_csv][1]
 
-        os.remove(tmp_file_path)
+@app.post("/analyze-pgn/")
+async def analyze_pgn(json_file: UploadFile = File(...), engine_path: str = "stockfish-windows-x86-64.exe", book_csv: str = DEFAULT_BOOK_CSV):
+    try:
+        # Parse the uploaded JSON straight from memory
+        game_data = json_loads(await json_file.read())
 
         # Check if the JSON file contains a game with a "Moves" list.
         if not isinstance(game_data, dict) or "Moves" not in game_data:
             raise HTTPException(status_code=400, detail="JSON file must contain game metadata and a 'Moves' list.")
 
-        # Analyze the JSON game
-        analysis_result = analyze_json_game_with_stockfish(game_data, engine_path, book_csv)
+        # Return the stored analysis if this game has been analysed before
+        digest = result_digest(game_data, engine_path, book_csv)
+        analysis_result = load_cached_result(digest)
+        if analysis_result is not None:
+            return {"analysis_results": analysis_result}
+
+        # Load the book and analyze the JSON game off the event loop so
+        # other requests keep being served
+        opening_book = await asyncio.to_thread(opening_book_for, book_csv)
+        analysis_result = await asyncio.to_thread(analyze_json_game_with_stockfish, game_data, engine_path, opening_book)
+        store_result(digest, analysis_result)
         return {"analysis_results": analysis_result}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 